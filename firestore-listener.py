@@ -17,43 +17,122 @@
 import os
 import argparse
 import sys
-import json
-import base64
+import binascii
 import time
+import random
 import datetime
-import traceback
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import shutil
+import functools
+import logging
 from google.cloud import firestore
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds
 from google.api_core.exceptions import GoogleAPIError
+from google.cloud.firestore_v1.document import DocumentReference, DocumentSnapshot
+from google.cloud.firestore_v1.services.firestore import client as firestore_client
+from google.cloud.firestore_v1.services.firestore.transports.grpc import FirestoreGrpcTransport
 from google.cloud.firestore_v1.watch import Watch
 from loguru import logger
-import logging
+import orjson
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop 不支持 Windows，此时只能使用 asyncio 默认的事件循环
+    uvloop = None
 
-def catch_exception(origin_func):
-    def wrapper(self, *args, **kwargs):
-        """
-        用于异常捕获的装饰器
-        :param origin_func:
-        :return:
-        """
+
+class InterceptHandler(logging.Handler):
+    """
+    将 logging 模块的日志转交给 loguru
+    """
+
+    def emit(self, record):
         try:
-            return origin_func(self, *args, **kwargs)
-        except AssertionError as e:
-            logger.error('参数错误：{}', str(e))
-        except GoogleAPIError as e:
-            logger.error('GoogleAPIError: ', str(e))
-        except Exception as e:
-            logger.error('出错：{} 位置：{}', str(e), traceback.format_exc())
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+
+        # 找到真正调用 logging 的位置，使日志中的模块、函数及行号正确
+        frame, depth = logging.currentframe(), 2
+        while frame.f_code.co_filename == logging.__file__:
+            frame = frame.f_back
+            depth += 1
+
+        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+
+
+class KeepaliveClient(firestore.Client):
+    """
+    自定义 gRPC 通道参数的 firestore 客户端
+    及早发现 NAT 或空闲超时导致的半开连接，避免监听悄无声息地断掉
+    """
+    GRPC_CHANNEL_OPTIONS = (
+        ('grpc.keepalive_time_ms', 30000),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+    )
+
+    @property
+    def _firestore_api(self):
+        # 连接模拟器时沿用默认通道
+        if self._firestore_api_internal is None and self._emulator_host is None:
+            channel = FirestoreGrpcTransport.create_channel(self._target, credentials=self._credentials,
+                                                            options=KeepaliveClient.GRPC_CHANNEL_OPTIONS)
+            self._transport = FirestoreGrpcTransport(host=self._target, channel=channel)
+            self._firestore_api_internal = firestore_client.FirestoreClient(transport=self._transport,
+                                                                            client_options=self._client_options)
+            firestore_client._client_info = self._client_info
+
+        return super()._firestore_api
+
+
+class ClosableWatch(Watch):
+    """
+    关闭时会回调 on_close 的 Watch
+    原生 Watch 关闭后只会悄悄地把 _closed 置为 True，只能轮询，这里改为主动通知
+    """
+    on_close = None
+
+    def close(self, reason=None):
+        try:
+            super().close(reason)
         finally:
-            pass
-
-    return wrapper
+            callable(self.on_close) and self.on_close(self)
 
 
 class FirestoreListener(object):
+    # 批量模式：收集文档的时间窗口（秒）
+    BATCH_WINDOW = 0.05
+
+    # 批量模式：单批文档数的上下限，下限至少为 2，保证始终能合并
+    MAX_BATCH_SIZE = 64
+    MIN_BATCH_SIZE = 2
+
+    # 批量模式：通过命令行参数传递时，单批文档 json 的字节数上限。Linux 限制单个参数不超过 128 KiB（MAX_ARG_STRLEN），
+    # base64 编码后会膨胀为 4/3 倍，故留足余量
+    MAX_BATCH_ARG_BYTES = 64 * 1024
+
+    # 批量模式：单批 php 调用的理想耗时（秒），据此按单个文档的平均耗时自动调整批大小
+    IDEAL_BATCH_DURATION = 2
+
+    # 积压的 php 任务没有空闲名额时，每隔多少秒提醒一次（秒）
+    SLOT_WAIT_TIMEOUT = 5
+
+    # 单次监听的文档数上限，突发写入时不至于只能收到最新的一个文档
+    WATCH_LIMIT = 50
+
+    # 服务端按 updatedAt 过滤时预留的余量，容忍写入方设置 updatedAt 时的时钟误差
+    UPDATED_AT_MARGIN = datetime.timedelta(minutes=1)
+
+    # 已处理文档的最新更新时间，持久化到此文件，重启后不会重复处理。分片监听时第 k 个分片的游标存放在 logs/cursor.k
+    CURSOR_PATH = 'logs/cursor'
+
+    # 监听中断后重连的最大退避时间（秒）
+    MAX_RECONNECT_BACKOFF = 60
+
     @logger.catch
     def __init__(self):
         FirestoreListener.check_py_version()
@@ -64,30 +143,60 @@ class FirestoreListener(object):
         # 日志
         self.__logger_setting()
 
-        # Firestore 日志：由于 firestore 的异常和日志是在它自己的子进程中处理的，外层无法捕获错误信息，但是 firestore 使用了 logging 模块写日志，故可将日志记录在文件中
-        logging.basicConfig(filename='logs/firestore.log', level=logging.DEBUG if self.args.debug else logging.INFO,
-                            format='[%(asctime)s] %(levelname)s | %(process)d:%(filename)s:%(name)s:%(lineno)d:%(module)s - %(message)s')
+        # Firestore 日志：由于 firestore 的异常和日志是在它自己的子进程中处理的，外层无法捕获错误信息，但是 firestore 使用了 logging 模块写日志，故将其转交给 loguru 统一记录
+        logging.basicConfig(handlers=[InterceptHandler()], level=logging.DEBUG if self.args.debug else logging.INFO)
 
         # firestore 数据库配置
-        self.db = firestore.Client.from_service_account_json(self.args.key_path)
+        self.db = KeepaliveClient.from_service_account_json(self.args.key_path)
         self.collection_id = self.args.collection_id
         self.restart_interval = self.args.restart_interval
-        self.doc_ref = None
-        self.doc_watch = None
+        self.doc_watches = []
+
+        # 监听分片数，大于 1 时按文档的 shard 字段拆成多个监听，每个监听各有一个回调线程
+        self.shards = max(self.args.shards, 1)
+
+        # 监听中断事件及重连退避时间（秒），收到快照后退避时间复位
+        self.watch_closed = None
+        self.backoff = 1
 
         # Create an Event for notifying main thread
         self.callback_done = threading.Event()
 
-        self.is_first_time = True
-        self.today = FirestoreListener.today()
+        # 只处理更新时间晚于游标的新增文档，游标为空时以首次快照的读取时间为准。各分片的游标互相独立
+        self.cursors = [FirestoreListener.load_cursor(shard) for shard in range(self.shards)]
+
+        # 各分片已见过的文档中最大的 updatedAt，每次开始监听时据此由服务端过滤，不必再传输已有的文档
+        # 与 updatedAt 字段本身比较，不受本机时钟及服务端写入时间的影响。尚未见过文档时不过滤
+        self.updated_at_marks = [None] * self.shards
 
-        # 线程池
+        # 事件循环，firestore 回调线程通过它把任务交给主线程执行
+        self.loop = None
+
+        # 同时执行的 php 进程数上限，信号量在事件循环启动后创建
         self.max_workers = self.args.max_workers
-        self.thread_pool_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.php_semaphore = None
 
-    @staticmethod
-    def today():
-        return str(datetime.date.today())
+        # php 可执行文件的绝对路径，只在启动时查找一次，避免每次执行外部命令都遍历 PATH
+        self.php_path = shutil.which('php') or 'php'
+
+        # 批量模式：由单独的派发协程将短时间内到达的文档合并为一次 php 调用
+        self.batch = self.args.batch
+        self.stdin = self.args.stdin
+        self.batch_size = FirestoreListener.MAX_BATCH_SIZE
+        self.doc_queue = None
+
+        # 常驻模式：启动 max_workers 个常驻的 php 进程，通过管道逐行派发文档，省去每次启动 php 框架的耗时
+        # 队列中存放空闲的 worker 进程，None 表示尚未启动或已退出，取用时再启动
+        self.worker = self.args.worker
+        self.idle_workers = None
+
+        # 持有尚未完成的 php 任务，防止被垃圾回收
+        self.pending_tasks = set()
+
+        # 限制积压的文档数，名额用完时阻塞 firestore 回调线程，而不是无限制地堆积在内存中
+        # 批量模式下每个进程一次处理多个文档，名额相应放大
+        max_pending = self.max_workers * 2 * (FirestoreListener.MAX_BATCH_SIZE if self.batch else 1)
+        self.slots = threading.BoundedSemaphore(max_pending)
 
     def __logger_setting(self) -> None:
         logger.remove()
@@ -95,11 +204,66 @@ class FirestoreListener(object):
         level = 'DEBUG' if self.args.debug else 'INFO'
         format = '<green>[{time:YYYY-MM-DD HH:mm:ss.SSS}]</green> <b><level>{level: <8}</level></b> | <cyan>{process.id}</cyan>:<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>'
 
-        logger.add('logs/{time:YYYY-MM-DD}.log', level=level, format=format, encoding='utf-8')
-        logger.add(sys.stderr, colorize=True, level=level, format=format)
+        # enqueue 使日志的格式化及写入在 loguru 的后台线程中进行，回调线程不会被 IO 阻塞
+        # 每天零点由 loguru 自动切换到新的日志文件，保留 30 天
+        logger.add('logs/{time:YYYY-MM-DD}.log', level=level, format=format, encoding='utf-8', enqueue=True,
+                   rotation='00:00', retention='30 days')
+        logger.add(sys.stderr, colorize=True, level=level, format=format, enqueue=True)
+
+    @staticmethod
+    def cursor_path(shard: int) -> str:
+        return FirestoreListener.CURSOR_PATH if shard == 0 else f'{FirestoreListener.CURSOR_PATH}.{shard}'
 
     @staticmethod
-    def check_py_version(major=3, minor=6):
+    def load_cursor(shard: int):
+        """
+        读取持久化的游标
+        :param shard:
+        :return:
+        """
+        try:
+            with open(FirestoreListener.cursor_path(shard), 'r') as f:
+                return DatetimeWithNanoseconds.from_rfc3339(f.read().strip())
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning('游标文件内容有误，将忽略：{}', str(e))
+
+            return None
+
+    @staticmethod
+    def save_cursor(shard: int, cursor: DatetimeWithNanoseconds) -> None:
+        """
+        持久化游标，先写临时文件再替换，防止写到一半时宕机导致文件损坏
+        :param shard:
+        :param cursor:
+        :return:
+        """
+        path = FirestoreListener.cursor_path(shard)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(cursor.rfc3339())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def get_updated_at(document: DocumentSnapshot):
+        """
+        获取文档的 updatedAt 字段，不存在或不是时间类型时返回 None
+        :param document:
+        :return:
+        """
+        try:
+            updated_at = document.get('updatedAt')
+        except KeyError:
+            return None
+
+        return updated_at if isinstance(updated_at, datetime.datetime) else None
+
+    @staticmethod
+    def check_py_version(major=3, minor=7):
         if sys.version_info < (major, minor):
             raise UserWarning(f'请使用 python {major}.{minor} 及以上版本，推荐使用 python 3.8')
 
@@ -116,8 +280,21 @@ class FirestoreListener(object):
         parser.add_argument('-k', '--key_path',
                             help='由谷歌提供的 json 格式的密钥文件的路径，更多信息参考：https://googleapis.dev/python/google-api-core/latest/auth.html',
                             required=True, type=str)
-        parser.add_argument('-mw', '--max_workers', help='最大线程数（在执行外部 php 命令时）', default=1, type=int)
+        parser.add_argument('-mw', '--max_workers', help='最大并发数（同时执行的外部 php 命令数）', default=1, type=int)
         parser.add_argument('-d', '--debug', help='是否开启 Debug 模式', action='store_true')
+        parser.add_argument('-b', '--batch', help='是否开启批量模式，将短时间内新增的多个文档合并为一次 php 调用（需要 php 命令支持 --batch 参数）',
+                            action='store_true')
+        mode_group = parser.add_mutually_exclusive_group()
+        mode_group.add_argument('-s', '--stdin', help='是否通过标准输入传递文档 json，而非 base64 编码后放在命令行参数中（需要 php 命令支持 --stdin 参数）',
+                                action='store_true')
+        mode_group.add_argument('-w', '--worker', help='是否开启常驻模式，由常驻的 php 进程逐行读取文档，不再每次都启动 php（需要 php 命令支持 --worker 参数）',
+                                action='store_true')
+        parser.add_argument('-sh', '--shards',
+                            help='监听分片数，大于 1 时按文档的 shard 字段拆分为多个监听并行处理（需要写入方设置 shard = crc32(id) %% 分片数，并建立 shard 与 updatedAt 的复合索引）',
+                            default=1, type=int)
+        parser.add_argument('-u', '--uvloop',
+                            help='是否使用 uvloop 事件循环（不支持 Windows）。启用后 php 进程改由 libuv 以 fork 方式启动，不再使用 posix_spawn',
+                            action='store_true')
         parser.add_argument('-r', '--restart_interval', help='重启间隔，每隔指定分钟后重启监听动作。单位：分钟', default=20, type=int)
 
         return parser.parse_args()
@@ -130,73 +307,339 @@ class FirestoreListener(object):
         raise TypeError(f'{type(obj)} 类型不可序列化为 json')
 
     @staticmethod
-    def __php_run(document: dict) -> None:
+    def __json_encode(document: dict) -> bytes:
+        # orjson 直接输出 utf-8 编码的 bytes，日期时间类型交给 __json_helper 处理以保持输出为时间戳
+        return orjson.dumps(document, default=FirestoreListener.__json_helper, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+    async def __php_run(self, doc_json: bytes, *options: str):
         """
         执行外部 php 命令
-        :param document:
+        直接以参数列表启动 php 进程，不经过 shell，省去一次 fork/exec 及参数转义
+        :param doc_json: 文档 json，批量模式下为文档数组 json
+        :param options: 传给 php 命令的额外选项
+        :return: php 命令本身的耗时（秒），不含排队等待的时间，出错时为 None
+        """
+        if self.worker:
+            return await self.__php_worker_run(doc_json, *options)
+
+        try:
+            cmd = [self.php_path, 'artisan', 'command:fcmpushformessage', *options]
+
+            # 通过标准输入传递时省去 base64 编码，也不受命令行参数长度限制
+            if self.stdin:
+                cmd.append('--stdin')
+                stdin = asyncio.subprocess.PIPE
+            else:
+                # 参数直接使用 bytes，subprocess 支持 bytes 参数，省去解码为 str 再编码回去的开销
+                cmd.append(binascii.b2a_base64(doc_json, newline=False))
+                stdin = asyncio.subprocess.DEVNULL
+
+            async with self.php_semaphore:
+                start_time = time.monotonic()
+
+                # 使用 asyncio 默认事件循环时，绝对路径加 close_fds=False 可让 subprocess 在 Linux 及 macOS 下改用 posix_spawn，
+                # 不必 fork 整个父进程；python 创建的文件描述符默认不可继承，不会因此泄漏给 php 进程
+                # 注意：指定 --uvloop 时由 libuv 以 fork 方式启动子进程，会忽略 close_fds，此参数不起作用
+                proc = await asyncio.create_subprocess_exec(*cmd, stdin=stdin, stdout=asyncio.subprocess.DEVNULL,
+                                                            stderr=asyncio.subprocess.PIPE, close_fds=False)
+                _, stderr = await proc.communicate(doc_json if self.stdin else None)
+                duration = time.monotonic() - start_time
+
+            if proc.returncode != 0:
+                logger.error('执行外部命令出错：{} 状态码：{} 错误输出：{}', ' '.join(map(os.fsdecode, cmd)), proc.returncode,
+                             stderr.decode('utf-8', errors='replace'))
+
+            return duration
+        except Exception as e:
+            logger.error('构造外部命令出错：{}', str(e))
+
+            return None
+
+    async def __start_php_worker(self, *options: str):
+        """
+        启动常驻的 php worker 进程
+        :param options: 传给 php 命令的额外选项
         :return:
         """
+        cmd = [self.php_path, 'artisan', 'command:fcmpushformessage', '--worker', *options]
+        logger.debug('启动 php worker 进程：{}', ' '.join(cmd))
+
+        # close_fds=False 的作用及 uvloop 下的限制同 __php_run
+
+        return await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                    close_fds=False)
+
+    @staticmethod
+    async def __kill_php_worker(proc):
+        """
+        杀掉并回收 php worker 进程，避免残留僵尸进程
+        :param proc:
+        :return: 进程的状态码，回收出错时为 None
+        """
         try:
-            doc_json = json.dumps(document, default=FirestoreListener.__json_helper, ensure_ascii=False).encode('utf-8')
-            doc_b64 = base64.b64encode(doc_json).decode('utf-8')
-            cmd = "php artisan command:fcmpushformessage '{}'".format(doc_b64)
+            if proc.returncode is None:
+                proc.kill()
+        except ProcessLookupError:
+            # 进程已自行退出，只需回收
+            pass
 
-            status_code = os.system(cmd)
-            if status_code != 0:
-                logger.error('执行外部命令出错：{}', cmd)
+        try:
+            return await proc.wait()
         except Exception as e:
-            logger.error('构造外部命令出错：{}', str(e))
+            logger.error('回收 php worker 进程出错：{}', str(e))
+
+            return None
+
+    async def __php_worker_run(self, doc_json: bytes, *options: str):
+        """
+        交给空闲的 php worker 进程执行
+        每行写入一个 base64 编码的文档，worker 处理完后回复一行 ok
+        :param doc_json:
+        :param options: 传给 php 命令的额外选项
+        :return: worker 处理的耗时（秒），不含等待空闲 worker 的时间，出错时为 None
+        """
+        proc = await self.idle_workers.get()
+        duration = None
+
+        try:
+            start_time = time.monotonic()
+
+            if proc is None or proc.returncode is not None:
+                proc = await self.__start_php_worker(*options)
+
+            # b2a_base64 默认以换行结尾，正好作为一行写入
+            proc.stdin.write(binascii.b2a_base64(doc_json))
+            await proc.stdin.drain()
+
+            reply = await proc.stdout.readline()
+            duration = time.monotonic() - start_time
+            if not reply:
+                # 关闭了 stdout 的 worker 可能仍在运行，先杀掉再回收，避免 wait 一直挂起
+                logger.error('php worker 进程意外退出，状态码：{}，下次派发时将重新启动',
+                             await self.__kill_php_worker(proc))
+                proc = None
+            elif reply.strip() != b'ok':
+                logger.error('php worker 处理出错：{}', reply.decode('utf-8', errors='replace').strip())
+        except Exception as e:
+            logger.error('php worker 通信出错：{}，下次派发时将重新启动', str(e))
+
+            # 通信中断后 worker 的状态未知，直接弃用
+            if proc is not None:
+                logger.debug('已弃用的 php worker 状态码：{}', await self.__kill_php_worker(proc))
+            proc = None
+        finally:
+            self.idle_workers.put_nowait(proc)
+
+        return duration
+
+    async def __php_run_batch(self, documents: list) -> None:
+        """
+        以批量模式执行外部 php 命令，并根据本批耗时调整下一批的大小
+        :param documents: 各文档的 json
+        :return:
+        """
+        # 只统计 php 本身的耗时，排队等待的时间不计入，否则负载高时批大小会被误判而缩小
+        duration = await self.__php_run(b'[' + b','.join(documents) + b']', '--batch')
+        if duration is None:
+            return
+
+        # php 框架的启动耗时被本批文档均摊，按单个文档的平均耗时估算理想耗时内能处理的文档数
+        per_doc_duration = max(duration / len(documents), 1e-3)
+        batch_size = int(FirestoreListener.IDEAL_BATCH_DURATION / per_doc_duration)
+        self.batch_size = min(max(batch_size, FirestoreListener.MIN_BATCH_SIZE), FirestoreListener.MAX_BATCH_SIZE)
+
+    def __spawn(self, coro, slots: int = 0) -> None:
+        """
+        在事件循环中以后台任务的方式执行协程
+        :param coro:
+        :param slots: 任务结束后归还的积压名额数
+        :return:
+        """
+        task = self.loop.create_task(coro)
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+        if slots:
+            task.add_done_callback(lambda _: self.__release_slots(slots))
+
+    def __release_slots(self, count: int) -> None:
+        for _ in range(count):
+            self.slots.release()
+
+    @logger.catch
+    async def __dispatch_batches(self) -> None:
+        """
+        批量派发协程
+        收集时间窗口内到达的文档，合并为一次 php 调用，分摊 php 框架的启动耗时
+        :return:
+        """
+        # 通过标准输入或常驻进程传递时不受命令行参数长度限制
+        max_bytes = None if self.stdin or self.worker else FirestoreListener.MAX_BATCH_ARG_BYTES
+
+        # 放不进上一批的文档，留作下一批的第一个
+        carry = None
+
+        while True:
+            documents = [carry if carry is not None else await self.doc_queue.get()]
+            carry = None
+            size = len(documents[0]) + 2
+            deadline = time.monotonic() + FirestoreListener.BATCH_WINDOW
+
+            while len(documents) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    doc_json = await asyncio.wait_for(self.doc_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                # 超出参数长度限制时 php 进程无法启动，整批都会丢失
+                if max_bytes is not None and size + len(doc_json) + 1 > max_bytes:
+                    carry = doc_json
+
+                    break
+
+                documents.append(doc_json)
+                size += len(doc_json) + 1
+
+            self.__spawn(self.__php_run_batch(documents), slots=len(documents))
+
+    async def __handle_change(self, doc_json: bytes) -> None:
+        """
+        处理新增文档，在事件循环中执行
+        :param doc_json:
+        :return:
+        """
+        # 批量模式下交给派发协程合并，否则直接执行
+        if self.batch:
+            await self.doc_queue.put(doc_json)
+        else:
+            self.__spawn(self.__php_run(doc_json), slots=1)
 
     @logger.catch
-    def __on_snapshot(self, col_snapshot, changes, read_time) -> None:
+    def __on_snapshot(self, col_snapshot, changes, read_time, shard=0) -> None:
         """
         Firestore 回调
         新增文档时触发执行外部命令
         :param col_snapshot:
         :param changes:
         :param read_time:
+        :param shard: 分片序号
         :return:
         """
-        # 常驻执行，更新日志目录
-        real_today = FirestoreListener.today()
-        if self.today != real_today:
-            self.today = real_today
-            self.__logger_setting()
+        # 能收到快照说明连接正常，复位重连退避时间
+        self.backoff = 1
+
+        # 首次启动时，快照中已有的文档都不处理
+        # 同一快照中的新增文档按查询顺序（新的在前）送达，故每个文档都与回调开始时的游标比较，最大值单独记录
+        cursor = read_time if self.cursors[shard] is None else self.cursors[shard]
+        new_cursor = cursor
 
         for change in changes:
+            if change.type.name in ('ADDED', 'MODIFIED'):
+                updated_at = FirestoreListener.get_updated_at(change.document)
+                if updated_at is not None and (self.updated_at_marks[shard] is None
+                                               or updated_at > self.updated_at_marks[shard]):
+                    self.updated_at_marks[shard] = updated_at
+
+            if change.type.name == 'MODIFIED':
+                # 修改也要推进游标，否则重启监听后该文档会以新增的身份再次送达，被当作新消息重复推送
+                new_cursor = max(new_cursor, change.document.update_time)
+
             if change.type.name == 'ADDED':
-                if self.is_first_time:
-                    self.is_first_time = False
+                # 跳过已处理过的文档，重启监听时快照中的旧文档也会在此被过滤
+                update_time = change.document.update_time
+                if update_time <= cursor:
+                    continue
+
+                new_cursor = max(new_cursor, update_time)
+
+                # to_dict 需要逐个字段转换，只调用一次
+                doc = change.document.to_dict()
+
+                # 回调运行在 firestore 的线程中，在此先完成序列化，再将任务交给事件循环
+                try:
+                    doc_json = FirestoreListener.__json_encode(doc)
+                except Exception as e:
+                    logger.error('序列化文档出错：{} 文档 ID: {}', str(e), change.document.id)
 
-                    return
+                    continue
 
-                # 将任务添加到线程池
-                self.thread_pool_executor.submit(FirestoreListener.__php_run, change.document.to_dict())
+                # 背压：积压过多时在此阻塞，直到有 php 任务完成
+                while not self.slots.acquire(timeout=FirestoreListener.SLOT_WAIT_TIMEOUT):
+                    logger.warning('php 任务积压过多，已等待 {} 秒仍无空闲名额，继续等待', FirestoreListener.SLOT_WAIT_TIMEOUT)
 
-                logger.debug('新增文档 ID: {} 内容: {}', change.document.id, change.document.to_dict())
+                asyncio.run_coroutine_threadsafe(self.__handle_change(doc_json), self.loop)
+
+                if self.args.debug:
+                    logger.debug('新增文档 ID: {} 内容: {}', change.document.id, doc)
+            elif not self.args.debug:
+                # 非 Debug 模式下不记录修改和移除，省去无用的 to_dict
+                continue
             elif change.type.name == 'MODIFIED':
                 logger.debug('修改文档 ID: {} 内容: {}', change.document.id, change.document.to_dict())
             elif change.type.name == 'REMOVED':
                 logger.debug('移除快照或文档 ID: {} 内容: {}', change.document.id, change.document.to_dict())
 
+        # 游标在 php 任务交给事件循环后即持久化，不等任务完成：进程在此之后崩溃时尚未完成的推送会丢失，
+        # 而不会在重启后重复推送，即至多推送一次
+        if new_cursor != self.cursors[shard]:
+            self.cursors[shard] = new_cursor
+            FirestoreListener.save_cursor(shard, new_cursor)
+
         # 通知主线程，当前线程已经完事儿了，防止阻塞
         self.callback_done.set()
 
-    @logger.catch
-    def __start_snapshot(self, force=False):
-        isinstance(self.doc_watch, Watch) and self.doc_watch.unsubscribe()
+    def __start_snapshot(self):
+        # 先摘下旧的 Watch 再关闭，否则其关闭回调在事件循环中仍能在 doc_watches 中找到自己，被误判为监听中断
+        old_watches, self.doc_watches = self.doc_watches, []
+
+        # 旧的 Watch 关闭失败也不影响重启，只是避免其后台线程泄漏
+        for doc_watch in old_watches:
+            try:
+                doc_watch.unsubscribe()
+            except Exception as e:
+                logger.warning('关闭旧的监听出错：{}', str(e))
 
-        self.doc_ref = self.db.collection(self.collection_id).order_by('updatedAt',
-                                                                       direction=firestore.Query.DESCENDING).limit(1)
+        for shard in range(self.shards):
+            query = self.db.collection(self.collection_id)
 
-        # 强行重启时防止重复触发回调
-        if force:
-            self.is_first_time = True
+            if self.shards > 1:
+                query = query.where('shard', '==', shard)
 
-        self.doc_watch = self.doc_ref.on_snapshot(self.__on_snapshot)
+            # 每次重启都以当前见过的最大 updatedAt 为准，重连时不会重复传输很久以前的文档
+            updated_at_mark = self.updated_at_marks[shard]
+            if updated_at_mark is not None:
+                query = query.where('updatedAt', '>', updated_at_mark - FirestoreListener.UPDATED_AT_MARGIN)
+
+            query = query.order_by('updatedAt', direction=firestore.Query.DESCENDING).limit(
+                FirestoreListener.WATCH_LIMIT)
+
+            doc_watch = ClosableWatch.for_query(query, functools.partial(self.__on_snapshot, shard=shard),
+                                                DocumentSnapshot, DocumentReference)
+            doc_watch.on_close = self.__on_watch_close
+            self.doc_watches.append(doc_watch)
+
+            # 设置回调前就已关闭的情况
+            doc_watch._closed and self.__on_watch_close(doc_watch)
+
+    def __on_watch_close(self, watch: Watch) -> None:
+        """
+        Watch 关闭时的回调，运行在 firestore 的线程中
+        :param watch:
+        :return:
+        """
+        self.loop.call_soon_threadsafe(self.__notify_watch_closed, watch)
+
+    def __notify_watch_closed(self, watch: Watch) -> None:
+        # 重启监听时主动关闭的旧 Watch 不算中断，任一分片中断则全部重启
+        if watch in self.doc_watches:
+            self.watch_closed.set()
 
     @logger.catch
-    def __listen_for_changes(self) -> None:
+    async def __listen_for_changes(self) -> None:
         """
         监听文档变化
         on_snapshot 方法在每次新增文档时候，会移除旧的快照，创建新的快照
@@ -204,37 +647,75 @@ class FirestoreListener(object):
         """
         logger.debug(f'开始实时监听，每隔 {self.restart_interval} 分钟将自动重启监听动作')
 
-        start_time = time.time()
-        self.__start_snapshot()
+        await self.__restart_snapshot()
 
         while True:
-            if time.time() - int(self.restart_interval) * 60 > start_time:
+            # 阻塞等待监听中断，不再轮询
+            try:
+                await asyncio.wait_for(self.watch_closed.wait(), int(self.restart_interval) * 60)
+            except asyncio.TimeoutError:
                 logger.debug('重启监听')
 
-                self.__start_snapshot(force=True)
-                start_time = time.time()
+                await self.__restart_snapshot()
 
                 continue
 
-            if self.doc_watch._closed:
-                logger.error('检测到 firestore 很不仗义的罢工了，将尝试重启')
+            self.watch_closed.clear()
 
-                try:
-                    self.__start_snapshot(force=True)
+            # 指数退避加随机抖动，防止频繁重连
+            delay = self.backoff + random.uniform(0, 1)
+            self.backoff = min(self.backoff * 2, FirestoreListener.MAX_RECONNECT_BACKOFF)
+            logger.error('检测到 firestore 很不仗义的罢工了，将在 {:.1f} 秒后尝试重启', delay)
 
-                    # 防止异常导致宕机
-                    time.sleep(1)
-                except Exception as e:
-                    logger.error('重启失败：{}', str(e))
+            await asyncio.sleep(delay)
 
-                    break
+            await self.__restart_snapshot()
+
+    async def __restart_snapshot(self) -> None:
+        """
+        开始或重启监听
+        出错时不退出，视为监听中断，按退避时间稍后重试
+        :return:
+        """
+        try:
+            # 关闭旧的 Watch 时会等待其回调线程退出，而回调线程可能正因背压等待 php 任务完成，
+            # 故放到线程池中执行，不阻塞事件循环
+            await self.loop.run_in_executor(None, self.__start_snapshot)
+        except GoogleAPIError as e:
+            logger.warning('firestore 暂时不可用，稍后重试：{}', str(e))
+
+            self.watch_closed.set()
+        except Exception:
+            logger.exception('开始监听失败，稍后重试')
+
+            self.watch_closed.set()
+
+    async def __main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.php_semaphore = asyncio.Semaphore(self.max_workers)
+        self.doc_queue = asyncio.Queue()
+        self.watch_closed = asyncio.Event()
+
+        if self.worker:
+            self.idle_workers = asyncio.Queue()
+            for _ in range(self.max_workers):
+                self.idle_workers.put_nowait(None)
+
+        if self.batch:
+            self.__spawn(self.__dispatch_batches())
 
-            time.sleep(0.001)
+        await self.__listen_for_changes()
 
     @logger.catch
-    @catch_exception
     def run(self):
-        self.__listen_for_changes()
+        # uvloop 基于 libuv，事件循环本身更快，但会使启动 php 进程时的 posix_spawn 失效，故需手动开启
+        if self.args.uvloop:
+            if uvloop is not None:
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            else:
+                logger.warning('未安装 uvloop，将使用 asyncio 默认的事件循环')
+
+        asyncio.run(self.__main())
 
 
 if __name__ == '__main__':